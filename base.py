@@ -32,6 +32,8 @@ class Suit(BaseStrEnum):
             raise Exception(f"Suit color not recognized: {suit}")
 
 class Viewable(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def get_game_view(self) -> str:
         raise NotImplementedError
@@ -41,6 +43,8 @@ class Viewable(ABC):
         raise NotImplementedError
 
 class Card(Viewable):
+    __slots__ = ('suit', 'rank', 'face_down') # there are many cards in every copy of a game
+
     def __init__(self, suit: Suit, rank: int, is_face_down: bool) -> None:
         assert rank >= 1 and rank <= 13
         self.suit = suit
@@ -69,6 +73,16 @@ class Card(Viewable):
     def copy(self) -> Card:
         return Card(self.suit, self.rank, self.face_down)
 
+    @staticmethod
+    def copy_all_into(cards: list[Card], source: list[Card]) -> None:
+        # makes cards a copy of source, reusing the card objects already in cards
+        del cards[len(source):]
+        for card, source_card in zip(cards, source):
+            card.suit = source_card.suit
+            card.rank = source_card.rank
+            card.face_down = source_card.face_down
+        cards.extend(card.copy() for card in source[len(cards):])
+
     def get_game_view(self) -> str:
         if self.face_down:
             return '[?]'
@@ -77,6 +91,26 @@ class Card(Viewable):
     def get_state_view(self) -> str:
         return str(self)
 
+class Zobrist:
+    # Random 64 bit keys for card placements, XOR-ed together to hash piles and games.
+    # The keys are shared by every game, so copies of a game always hash alike.
+    _keys: dict[tuple, int] = {}
+    _random = random.Random(0)
+
+    @staticmethod
+    def key(*placement) -> int:
+        value = Zobrist._keys.get(placement)
+        if value is None:
+            value = Zobrist._random.getrandbits(64)
+            Zobrist._keys[placement] = value
+        return value
+
+    @staticmethod
+    def card_key(tag: str, slot: int, card: Card) -> int:
+        if card.face_down: # face down cards are indistinguishable, same as in the game view
+            return Zobrist.key(tag, slot)
+        return Zobrist.key(tag, slot, card.suit, card.rank)
+
 class Deck:
     def __init__(self, times:int=1, suits:list[Suit]|None=None) -> None:
         is_face_down = True
@@ -112,35 +146,93 @@ class Deck:
         deck = Deck(0)
         deck.cards = [card.copy() for card in self.cards]
         return deck
+
+    def copy_from(self, deck: Deck) -> None:
+        Card.copy_all_into(self.cards, deck.cards)
     
 class Pile(Viewable):
     def __init__(self, cards: list[Card], name: str) -> None:
         self.cards: list[Card] = cards
         self.name = name
+        self.zobrist: int = 0 # kept in sync by the methods below, call rehash after changing cards directly
+        # rendered views, dropped by the same methods whenever the cards change
+        self._state_view: str|None = None
+        self._game_view: str|None = None
     
     def get_all_cards(self) -> list[Card]:
         return self.cards
 
+    def rehash(self) -> None:
+        tag = self.get_tag()
+        self.zobrist = 0
+        self._state_view = self._game_view = None
+        for slot, card in enumerate(self.cards):
+            self.zobrist ^= Zobrist.card_key(tag, slot, card)
+
+    def face_top(self) -> None:
+        card = self.peak()
+        slot = len(self.cards) - 1
+        self.zobrist ^= Zobrist.card_key(self.get_tag(), slot, card)
+        card.face()
+        self.zobrist ^= Zobrist.card_key(self.get_tag(), slot, card)
+        self._state_view = self._game_view = None
+
     @abstractmethod
     def copy(self) -> Pile:
         raise NotImplementedError
+
+    # same as copy, but overwrites this pile in place; pile should be the same pile in another copy of the game
+    def copy_from(self, pile: Pile) -> None:
+        Card.copy_all_into(self.cards, pile.cards)
+        self.zobrist = pile.zobrist
+        self._state_view, self._game_view = pile._state_view, pile._game_view
+
+    # cheap record of the pile to undo an action with; cards are shared, only their order and faces are kept
+    def snapshot(self) -> tuple:
+        return (list(self.cards), [card.face_down for card in self.cards], self.zobrist, self._state_view, self._game_view)
+
+    def restore(self, snapshot: tuple) -> None:
+        cards, face_downs, self.zobrist, self._state_view, self._game_view = snapshot
+        for card, face_down in zip(cards, face_downs):
+            card.face_down = face_down
+        self.cards = cards
     
     def get_game_view(self) -> str:
         return ', '.join([card.get_game_view() for card in self.cards])
 
     def get_state_view(self) -> str:
         return ', '.join([card.get_state_view() for card in self.cards])
+
+    def get_cached_state_view(self) -> str:
+        if self._state_view is None:
+            self._state_view = self.get_state_view()
+        return self._state_view
+
+    def get_cached_game_view(self) -> str:
+        if self._game_view is None:
+            self._game_view = self.get_game_view()
+        return self._game_view
     
     def empty(self) -> bool:
         return len(self.cards) == 0
 
     def get(self) -> Card:
         assert not self.empty(), "Cannot get card from empty pile"
+        self.zobrist ^= Zobrist.card_key(self.get_tag(), len(self.cards) - 1, self.cards[-1])
+        self._state_view = self._game_view = None
         return self.cards.pop(-1)
     
     def peak(self) -> Card:
         assert not self.empty(), "Cannot get card from empty pile"
         return self.cards[-1]
+
+    # hash change of taking the top count cards the way get does, without changing the pile
+    def removal_hash(self, count: int) -> int:
+        tag = self.get_tag()
+        delta = 0
+        for slot in range(len(self.cards) - count, len(self.cards)):
+            delta ^= Zobrist.card_key(tag, slot, self.cards[slot])
+        return delta
     
     def len(self) -> int:
         return len(self.cards)
@@ -154,7 +246,7 @@ class DealPile(Pile):
         self.target_names = target_names
 
     def get(self) -> Card:
-        self.peak().face()
+        self.face_top()
         return super().get()
     
     def get_game_view(self) -> str:
@@ -165,7 +257,9 @@ class DealPile(Pile):
     
     def copy(self) -> DealPile:
         cards_copy = [card.copy() for card in self.cards]
-        return DealPile(cards_copy, self.target_names)
+        copy = DealPile(cards_copy, self.target_names)
+        copy.zobrist = self.zobrist
+        return copy
     
 # possibly, RotateDrawPile can be represented using 3 separate piles.
 # However, this representation can make things too complicated, since it can't inherit from pile anymore.
@@ -194,8 +288,37 @@ class RotateDrawPile(Pile):
         copy.backpile = [card.copy() for card in self.backpile]
         copy.drawn = [card.copy() for card in self.drawn]
         copy.redeals = self.redeals
+        copy.zobrist = self.zobrist
         return copy
 
+    def copy_from(self, pile: Pile) -> None:
+        assert isinstance(pile, RotateDrawPile)
+        super().copy_from(pile)
+        Card.copy_all_into(self.backpile, pile.backpile)
+        Card.copy_all_into(self.drawn, pile.drawn)
+        self.redeals = pile.redeals
+
+    def snapshot(self) -> tuple:
+        hidden = self.backpile + self.drawn
+        return (super().snapshot(), list(self.backpile), list(self.drawn), [card.face_down for card in hidden], self.redeals)
+
+    def restore(self, snapshot: tuple) -> None:
+        visible, backpile, drawn, face_downs, self.redeals = snapshot
+        for card, face_down in zip(backpile + drawn, face_downs):
+            card.face_down = face_down
+        super().restore(visible)
+        self.backpile = backpile
+        self.drawn = drawn
+
+    def rehash(self) -> None:
+        super().rehash()
+        tag = self.get_tag()
+        for slot, card in enumerate(self.backpile):
+            self.zobrist ^= Zobrist.card_key(f'{tag}:backpile', slot, card)
+        for slot, card in enumerate(self.drawn):
+            self.zobrist ^= Zobrist.card_key(f'{tag}:drawn', slot, card)
+        self.zobrist ^= Zobrist.key(tag, 'redeals', self.redeals)
+
     def rotate(self, perform: bool = True) -> bool:
         if len(self.backpile) > 0:
             if not perform:
@@ -217,6 +340,7 @@ class RotateDrawPile(Pile):
         else:
             # print(f"[Warning] Max redeals reached: {self.redeals}/{self.max_redeals} redeals")
             return False
+        self.rehash()
         return True
     
     def get_game_view(self) -> str:
@@ -255,20 +379,37 @@ class Stack(Pile):
                 if should_face:
                     card.face()
                 should_face = not should_face
+        self.rehash()
 
     def get(self) -> Card:
         ret = super().get()
         if not self.empty():
-            self.peak().face()
+            self.face_top()
         return ret
     
     def get_many(self, from_ind: int) -> list[Card]:
-        cards = self.peak_many(from_ind)
-        self.cards = self.cards[:from_ind]
+        cards = self.pop_from(from_ind)
         if not self.empty():
-            self.peak().face()
+            self.face_top()
         return cards
     
+    def removal_hash(self, count: int) -> int:
+        delta = super().removal_hash(count)
+        slot = len(self.cards) - count - 1
+        if slot >= 0 and self.cards[slot].face_down: # get and get_many face the new top card
+            card = self.cards[slot]
+            tag = self.get_tag()
+            delta ^= Zobrist.card_key(tag, slot, card) ^ Zobrist.key(tag, slot, card.suit, card.rank)
+        return delta
+
+    # hash change of adding the cards, without changing the pile
+    def addition_hash(self, cards: list[Card]) -> int:
+        tag = self.get_tag()
+        delta = 0
+        for slot, card in enumerate(cards, len(self.cards)):
+            delta ^= Zobrist.card_key(tag, slot, card)
+        return delta
+
     def peak_many(self, from_ind: int) -> list[Card]:
         assert from_ind < self.len(), f"Not enough card to get from index {from_ind}"
         return self.cards[from_ind:]
@@ -277,13 +418,21 @@ class Stack(Pile):
         assert ind >= 0 and ind < self.len()
         ret = self.cards[ind:]
         self.cards = self.cards[:ind]
+        tag = self.get_tag()
+        for slot, card in enumerate(ret, ind):
+            self.zobrist ^= Zobrist.card_key(tag, slot, card)
+        self._state_view = self._game_view = None
         return ret
 
     def add(self, cards: list[Card]) -> None:
+        self.zobrist ^= self.addition_hash(cards)
+        self._state_view = self._game_view = None
         self.cards += cards
     
     def copy(self) -> Stack:
-        return Stack([card.copy() for card in self.cards], self.name, self.ind)
+        copy = Stack([card.copy() for card in self.cards], self.name, self.ind)
+        copy.zobrist = self.zobrist
+        return copy
     
     def get_tag(self) -> str:
         return f'{self.name}{f"[{self.ind}]" if self.ind is not None else ""}'
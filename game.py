@@ -3,7 +3,7 @@ from typing import Callable, Sequence, Protocol, ParamSpec, Generic, TypeVar
 from abc import ABC, abstractmethod
 from base import Deck, Card, Stack, Pile, DealPile, RotateDrawPile, Viewable
 import condition as cond
-from utility import Logger
+from utility import Logger, NULL_LOGGER
 from enum import Enum
 import random
 
@@ -55,6 +55,12 @@ class GameAction(Generic[P]):
             kwargs[arg] = val
         return self.func(*self.args, **kwargs)
 
+    # the same action, acting on another copy of the game
+    def bound_to(self, game: Game) -> GameAction:
+        if getattr(self.func, '__self__', None) is game:
+            return self
+        return GameAction(getattr(game, self.func.__name__), *self.args, **self.kwargs)
+
     def __str__(self) -> str:
         all_args = list(self.args) + list(self.kwargs.values())
         return f"{self.func.__name__} {' '.join([str(arg) for arg in all_args])}"
@@ -157,7 +163,23 @@ class MoveStackArgs(ActionArgs[cond.MoveStackComponents]):
             condition: cond.Condition[cond.MoveStackComponents]|None = game.move_stack_conditions.get((src_pos.stack_pos.pilename, dest_pos.pilename), None)
         return MoveStackArgs(src_pile, src_pos.from_ind, dest_pile, condition)
 
+# what is needed to take back a performed action, see Game.begin_undo
+class UndoRecord:
+    def __init__(self, game: Game) -> None:
+        self.zobrist = game.zobrist
+        self.valid_actions = game._valid_actions
+        self.win = game._win
+        self.snapshots: list[tuple[Pile, tuple]] = [] # in the order the piles were touched, auto moves included
+
+_GAME_POOL: list[Game] = [] # released games, copy() overwrites them instead of allocating new ones
+_GAME_POOL_SIZE = 128
+
 class Game(Viewable):
+    __slots__ = ('name', 'deck', 'unshuffled_deck', 'draw_pile', 'started', 'initializers', 'name_to_piles',
+                 'move_conditions', 'move_stack_conditions', 'auto_move_conditions', 'auto_move_stack_conditions',
+                 'move_index', 'move_stack_index', 'auto_move_index', 'auto_move_stack_index',
+                 'draw_func', 'draw_conditions', 'win_conditions', 'logger', '_valid_actions', '_win', 'zobrist', '_undo')
+
     class MoveType(Enum):
         Move = 1
         MoveStack = 2
@@ -166,6 +188,7 @@ class Game(Viewable):
     def __init__(self, name: str, should_log: bool = True) -> None:
         self.name: str = name
         self.deck: Deck = Deck(0)
+        self.unshuffled_deck: Deck|None = None # kept to deal the game again, see restart
         self.draw_pile: Pile|None = None
         self.started = False
         self.initializers: list[Callable[[], None]] = []
@@ -174,18 +197,50 @@ class Game(Viewable):
         self.move_stack_conditions: dict[tuple[str, str], cond.Condition[cond.MoveStackComponents]] = {}
         self.auto_move_conditions: dict[tuple[str, str], cond.Condition[cond.MoveCardComponents]] = {}
         self.auto_move_stack_conditions: dict[tuple[str, str], cond.Condition[cond.MoveStackComponents]] = {}
+        # destination pilenames of the conditions above, grouped by source pilename
+        self.move_index: dict[str, list[str]] = {}
+        self.move_stack_index: dict[str, list[str]] = {}
+        self.auto_move_index: dict[str, list[str]] = {}
+        self.auto_move_stack_index: dict[str, list[str]] = {}
         self.draw_func: DrawCallable
         self.draw_conditions: cond.Condition[cond.GeneralConditionComponents]|None = None
         self.win_conditions: cond.Condition[cond.GeneralConditionComponents]|None = None
         self.logger: Logger = Logger(should_log)
+        self._valid_actions: list[GameAction]|None = None # cleared whenever the game changes, copies share it until then
+        self._win: bool|None = None # same as above
+        self.zobrist: int = 0 # XOR of the pile hashes, updated with every performed action
+        self._undo: UndoRecord|None = None
 
     def start(self):
         for initializer in self.initializers:
             initializer()
         self.started = True
+        self._clear_caches()
+        self.zobrist = 0
+        for pile in self.get_all_piles():
+            pile.rehash()
+            self.zobrist ^= pile.zobrist
+
+    # deals the game again with a new shuffle, same as parsing it again with the seed. Copies cannot restart.
+    def restart(self, seed: int|None) -> None:
+        assert self.unshuffled_deck is not None, "Cannot restart a game without a deck"
+        assert len(self.initializers) > 0, "Cannot restart a copied game"
+        self.deck = self.unshuffled_deck.copy()
+        self.deck.shuffle(seed)
+        if isinstance(self.draw_pile, RotateDrawPile):
+            self.draw_pile.backpile = []
+            self.draw_pile.drawn = []
+            self.draw_pile.redeals = 0
+        self.start()
 
     def copy(self) -> Game:
+        if len(_GAME_POOL) > 0 and _GAME_POOL[-1].move_conditions is self.move_conditions: # same game definition
+            game = _GAME_POOL.pop()
+            game._copy_from(self)
+            return game
         game = Game(self.name, self.logger.active)
+        if self.logger is NULL_LOGGER: # copies of a silent game are silent too
+            game.logger = NULL_LOGGER
         game.started = self.started
         game.deck = self.deck.copy()
         game.draw_pile = self.draw_pile.copy() if self.draw_pile is not None else None
@@ -194,14 +249,72 @@ class Game(Viewable):
         game.move_stack_conditions = self.move_stack_conditions
         game.auto_move_conditions = self.auto_move_conditions
         game.auto_move_stack_conditions = self.auto_move_stack_conditions
+        game.move_index = self.move_index
+        game.move_stack_index = self.move_stack_index
+        game.auto_move_index = self.auto_move_index
+        game.auto_move_stack_index = self.auto_move_stack_index
         if isinstance(game.draw_pile, DealPile):
             game._submit_deal_draw_func(game.draw_pile.target_names)
         elif isinstance(game.draw_pile, RotateDrawPile):
             game.draw_func = game.draw_pile.rotate
         game.draw_conditions = self.draw_conditions
         game.win_conditions = self.win_conditions
+        game._valid_actions = self._valid_actions
+        game._win = self._win
+        game.zobrist = self.zobrist
+        return game
+
+    # copy used only for simulations, it never logs
+    def silent_copy(self) -> Game:
+        game = self.copy()
+        game.logger = NULL_LOGGER
         return game
+
+    # the caller promises not to use this game anymore, so that a later copy can reuse it
+    def release(self) -> None:
+        if len(_GAME_POOL) < _GAME_POOL_SIZE:
+            _GAME_POOL.append(self)
+
+    def _copy_from(self, game: Game) -> None:
+        self.started = game.started
+        if game.logger is NULL_LOGGER:
+            self.logger = NULL_LOGGER
+        elif self.logger is NULL_LOGGER:
+            self.logger = Logger(game.logger.active)
+        else:
+            self.logger.active = self.logger.static_activate = game.logger.active
+        self.deck.copy_from(game.deck)
+        if self.draw_pile is not None and game.draw_pile is not None:
+            self.draw_pile.copy_from(game.draw_pile)
+        for piles, source_piles in zip(self.name_to_piles.values(), game.name_to_piles.values()):
+            for pile, source_pile in zip(piles, source_piles):
+                pile.copy_from(source_pile)
+        self._valid_actions = game._valid_actions
+        self._win = game._win
+        self.zobrist = game.zobrist
     
+    # records the piles touched by the following actions, until end_undo is called
+    def begin_undo(self) -> None:
+        assert self._undo is None, "Cannot record two undos at the same time"
+        self._undo = UndoRecord(self)
+
+    def end_undo(self) -> UndoRecord:
+        assert self._undo is not None, "No undo is being recorded"
+        undo, self._undo = self._undo, None
+        return undo
+
+    def undo(self, undo: UndoRecord) -> None:
+        for pile, snapshot in reversed(undo.snapshots): # the earliest snapshot of a pile is restored last
+            pile.restore(snapshot)
+        self.zobrist = undo.zobrist
+        self._valid_actions = undo.valid_actions
+        self._win = undo.win
+
+    def _record_undo(self, piles: list[Pile]) -> None:
+        if self._undo is not None:
+            for pile in set(piles):
+                self._undo.snapshots.append((pile, pile.snapshot()))
+
     def scramble(self, seed: int|None):
         # shuffle unknown cards to prevent bots from perfect predictions
         class CardAccess:
@@ -242,6 +355,11 @@ class Game(Viewable):
         cards: list[Card] = [access.get_card() for access in card_locations]
         for i, j in enumerate(shuffled):
             card_locations[i].set_card(cards[j])
+        self._clear_caches()
+        self.zobrist = 0
+        for any_pile in self.get_all_piles(): # also drops the cached views, the hidden cards changed
+            any_pile.rehash()
+            self.zobrist ^= any_pile.zobrist
 
     def get_all_cards(self) -> list[Card]:
         all_cards: list[Card] = []
@@ -258,12 +376,16 @@ class Game(Viewable):
         return all_piles
 
     def is_win(self):
+        if self._win is not None:
+            return self._win
         assert self.started, "Cannot check the win condition if game has not started"
         assert self.win_conditions is not None, "No win condition defined for the game"
         components = cond.GeneralConditionComponents(self.name_to_piles, self.draw_pile)
         # self.logger.info("WIN CONDITIONS:\n" + self.win_conditions.summary(components))
-        self.logger.info_from(["WIN CONDITIONS:\n", (self.win_conditions.summary, [components])])
-        return self.win_conditions.evaluate(components)
+        if self.logger.active:
+            self.logger.info_from(["WIN CONDITIONS:\n", (self.win_conditions.summary, [components])])
+        self._win = self.win_conditions.evaluate(components)
+        return self._win
     
     def get_draw_summary(self, all_resolutions: bool, explain: bool) -> str:
         args = DrawArgs.get(self)
@@ -273,14 +395,27 @@ class Game(Viewable):
         assert self.started, "Cannot draw if game has not started"
         args = DrawArgs.get(self)
         if args.condition is not None and args.components is not None:
-            self.logger.info_from(["DRAW CONDITIONS:\n", (args.condition.summary, [args.components])])
+            if self.logger.active:
+                self.logger.info_from(["DRAW CONDITIONS:\n", (args.condition.summary, [args.components])])
             if not args.condition.evaluate(args.components):
                 return False
+        if perform:
+            piles = self.get_all_piles() # a deal can reach every pile
+            self._record_undo(piles)
+            self._toggle_zobrist(piles)
         valid = self.draw_func(perform)
+        if perform:
+            self._toggle_zobrist(piles)
         if valid and perform:
+            self._clear_caches()
             self.check_auto_moves()
         return valid
 
+    def define_deck(self, deck: Deck, seed: int|None) -> None:
+        self.unshuffled_deck = deck.copy()
+        self.deck = deck
+        self.deck.shuffle(seed)
+
     def define_deal_draw(self, count: int, targets: list[str]) -> None:
         assert self.draw_pile is None, "Defining multiple draw conditions for a game is invalid"
         def initializer():
@@ -348,14 +483,24 @@ class Game(Viewable):
         args = MoveArgs.from_pos(self, src_pos, dest_pos, auto)
         if args.condition is None or args.components is None:
             return False
-        self.logger.info_from([f"MOVE_CONDITIONS {src_pos} to {dest_pos}\n", (args.condition.summary, [args.components])])
+        if self.logger.active:
+            self.logger.info_from([f"MOVE_CONDITIONS {src_pos} to {dest_pos}\n", (args.condition.summary, [args.components])])
         if not args.condition.evaluate(args.components):
             return False
         if perform:
+            self._record_undo([args.src_pile, args.dest_pile])
+            self._toggle_zobrist([args.src_pile, args.dest_pile])
             args.dest_pile.add([args.src_pile.get()])
+            self._toggle_zobrist([args.src_pile, args.dest_pile])
+            self._clear_caches()
             self.check_auto_moves()
         return True
     
+    # XORs the hashes of the given piles out of the game hash before they change, and back in after
+    def _toggle_zobrist(self, piles: list[Pile]) -> None:
+        for pile in set(piles):
+            self.zobrist ^= pile.zobrist
+    
     def get_move_summary(self, all_resolutions: bool, explain: bool, src_pos: PilePos, dest_pos: StackPilePos, auto: bool=False) -> str:
         args = MoveArgs.from_pos(self, src_pos, dest_pos, auto)
         return args.get_summary(all_resolutions, explain)
@@ -365,14 +510,40 @@ class Game(Viewable):
         args = MoveStackArgs.from_pos(self, src_pos, dest_pos, auto)
         if args.condition is None or args.components is None:
             return False
-        self.logger.info_from([f"MOVE_STACK CONDITIONS {src_pos} to {dest_pos}\n", (args.condition.summary, [args.components])])
+        if self.logger.active:
+            self.logger.info_from([f"MOVE_STACK CONDITIONS {src_pos} to {dest_pos}\n", (args.condition.summary, [args.components])])
         if not args.condition.evaluate(args.components):
             return False
         if perform:
+            self._record_undo([args.src_pile, args.dest_pile])
+            self._toggle_zobrist([args.src_pile, args.dest_pile])
             args.dest_pile.add(args.src_pile.get_many(src_pos.from_ind))
+            self._toggle_zobrist([args.src_pile, args.dest_pile])
+            self._clear_caches()
             self.check_auto_moves()
         return True
     
+    # Hash of the game after the move, without performing it. Validity is not checked.
+    # None if the hash cannot be known beforehand, when auto moves may follow the move.
+    def get_move_hash(self, src_pos: PilePos, dest_pos: StackPilePos) -> int|None:
+        src_pile = self._get_pile(src_pos)
+        dest_pile = self._get_stack(dest_pos)
+        if src_pile is None or dest_pile is None or src_pile.empty():
+            return None
+        return self._get_moved_hash(src_pile, src_pile.len() - 1, dest_pile)
+
+    def get_move_stack_hash(self, src_pos: RunPos, dest_pos: StackPilePos) -> int|None:
+        src_pile = self._get_stack(src_pos.stack_pos)
+        dest_pile = self._get_stack(dest_pos)
+        if src_pile is None or dest_pile is None or src_pos.from_ind >= src_pile.len():
+            return None
+        return self._get_moved_hash(src_pile, src_pos.from_ind, dest_pile)
+
+    def _get_moved_hash(self, src_pile: Pile, from_ind: int, dest_pile: Stack) -> int|None:
+        if len(self.auto_move_index) > 0 or len(self.auto_move_stack_index) > 0 or src_pile is dest_pile:
+            return None
+        return self.zobrist ^ src_pile.removal_hash(src_pile.len() - from_ind) ^ dest_pile.addition_hash(src_pile.cards[from_ind:])
+
     def get_move_stack_summary(self, all_resolutions: bool, explain: bool, src_pos: RunPos, dest_pos: StackPilePos, auto: bool=False) -> str:
         args = MoveStackArgs.from_pos(self, src_pos, dest_pos, auto)
         return args.get_summary(all_resolutions, explain)
@@ -398,35 +569,46 @@ class Game(Viewable):
         assert self._check_pilename(dest_pilename, True), f"Cannot define move to non-existent or non-stack pile {dest_pilename}"
         assert (src_pilename, dest_pilename) not in self.move_conditions, f"Cannot define move conditions for same piles twice, use AND or OR to combine the rules"
         self.move_conditions[(src_pilename, dest_pilename)] = condition
+        Game._add_to_index(self.move_index, src_pilename, dest_pilename)
     
     def define_stack_move(self, src_pilename: str, dest_pilename: str, condition: cond.Condition[cond.MoveStackComponents]) -> None:
         assert self._check_pilename(src_pilename, True), f"Cannot define stack move from non-existent or non-stack pile {src_pilename}"
         assert self._check_pilename(dest_pilename, True), f"Cannot define stack move to non-existent or non-stack pile {dest_pilename}"
         assert (src_pilename, dest_pilename) not in self.move_stack_conditions, f"Cannot define move_stack conditions for same piles twice, use AND or OR to combine the rules"
         self.move_stack_conditions[(src_pilename, dest_pilename)] = condition
+        Game._add_to_index(self.move_stack_index, src_pilename, dest_pilename)
 
     def define_auto_move(self, src_pilename: str, dest_pilename: str, condition: cond.Condition[cond.MoveCardComponents]) -> None:
         assert self._check_pilename(src_pilename, False), f"Cannot define auto move from non-existent pile {src_pilename}"
         assert self._check_pilename(dest_pilename, True), f"Cannot define auto move to non-existent or non-stack pile {dest_pilename}"
         self.auto_move_conditions[(src_pilename, dest_pilename)] = condition
+        Game._add_to_index(self.auto_move_index, src_pilename, dest_pilename)
     
     def define_auto_stack_move(self, src_pilename: str, dest_pilename: str, condition: cond.Condition[cond.MoveStackComponents]) -> None:
         assert self._check_pilename(src_pilename, True), f"Cannot define auto stack move from non-existent or non-stack pile {src_pilename}"
         assert self._check_pilename(dest_pilename, True), f"Cannot define auto stack move to non-existent or non-stack pile {dest_pilename}"
         self.auto_move_stack_conditions[(src_pilename, dest_pilename)] = condition
+        Game._add_to_index(self.auto_move_stack_index, src_pilename, dest_pilename)
+
+    @staticmethod
+    def _add_to_index(index: dict[str, list[str]], src_pilename: str, dest_pilename: str) -> None:
+        dest_pilenames = index.setdefault(src_pilename, [])
+        if dest_pilename not in dest_pilenames:
+            dest_pilenames.append(dest_pilename)
     
     def check_auto_moves(self):
         assert self.started, "Cannot check auto move if game has not started"
         while(True):
             actions: list[GameAction] = []
-            for src_pilename, dest_pilename in self.auto_move_conditions.keys():
-                actions += self._get_move_actions(src_pilename, dest_pilename, True)
-            for src_pilename, dest_pilename in self.auto_move_stack_conditions.keys():
-                actions += self._get_move_stack_actions(src_pilename, dest_pilename, True)
+            for src_pilename, dest_pilenames in self.auto_move_index.items():
+                actions += self._get_move_actions(src_pilename, dest_pilenames, True)
+            for src_pilename, dest_pilenames in self.auto_move_stack_index.items():
+                actions += self._get_move_stack_actions(src_pilename, dest_pilenames, True)
             actions = self._filter_valid(actions, auto=True)
             if len(actions) == 0:
                 break
-            self.logger.info(f"valid auto-action found: {actions[0]}")
+            if self.logger.active:
+                self.logger.info(f"valid auto-action found: {actions[0]}")
             actions[0].act(perform=True, auto=True)
 
     def _get_stack_pile_positions(self, pilename) -> Sequence[StackPilePos]:
@@ -446,63 +628,87 @@ class Game(Viewable):
         self.logger.revert_activation()
         return actions
     
-    def _get_move_actions(self, src_pilename: str, dest_pilename: str, only_valid: bool) -> list[GameAction[PilePos, StackPilePos, bool, bool]]:
+    # with only_valid, sources that cannot give away a face up card are skipped for all destinations at once
+    def _get_move_actions(self, src_pilename: str, dest_pilenames: list[str], only_valid: bool) -> list[GameAction[PilePos, StackPilePos, bool, bool]]:
         actions: list[GameAction[PilePos, StackPilePos, bool, bool]] = []
         for src_pos in self._get_pile_positions(src_pilename):
-            for dest_pos in self._get_stack_pile_positions(dest_pilename):
-                if str(src_pos) != str(dest_pos):
-                    actions.append(GameAction(self.move, src_pos=src_pos, dest_pos=dest_pos))
+            if only_valid:
+                src_pile = self._get_pile(src_pos)
+                if src_pile is None or src_pile.empty() or src_pile.peak().face_down:
+                    continue
+            for dest_pilename in dest_pilenames:
+                for dest_pos in self._get_stack_pile_positions(dest_pilename):
+                    if str(src_pos) != str(dest_pos):
+                        actions.append(GameAction(self.move, src_pos=src_pos, dest_pos=dest_pos))
         return actions
 
-    def _get_move_stack_actions(self, src_pilename: str, dest_pilename: str, only_valid: bool) -> list[GameAction[RunPos, StackPilePos, bool, bool]]:
+    def _get_move_stack_actions(self, src_pilename: str, dest_pilenames: list[str], only_valid: bool) -> list[GameAction[RunPos, StackPilePos, bool, bool]]:
         actions: list[GameAction[RunPos, StackPilePos, bool, bool]] = []
         for src_pos in self._get_stack_pile_positions(src_pilename):
             src_pile = self._get_stack(src_pos)
             if src_pile is None:
                 continue
-            for dest_pos in self._get_stack_pile_positions(dest_pilename):
-                if str(src_pos) == str(dest_pos):
-                    continue
-                for i in range(src_pile.len() - 2, -1, -1): # stack should have a size of at least 2
-                    dest_pile = self.name_to_piles[dest_pilename]
-                    if isinstance(dest_pile, Stack) and dest_pile.cards[i].face_down:
-                        break
-                    actions.append(GameAction(self.move_stack, src_pos=RunPos(src_pos, i), dest_pos=dest_pos))
+            if only_valid and (src_pile.len() < 2 or src_pile.peak().face_down):
+                continue
+            for dest_pilename in dest_pilenames:
+                for dest_pos in self._get_stack_pile_positions(dest_pilename):
+                    if str(src_pos) == str(dest_pos):
+                        continue
+                    for i in range(src_pile.len() - 2, -1, -1): # stack should have a size of at least 2
+                        if only_valid and src_pile.cards[i].face_down: # so would every deeper stack
+                            break
+                        actions.append(GameAction(self.move_stack, src_pos=RunPos(src_pos, i), dest_pos=dest_pos))
         return actions
 
+    def _clear_caches(self) -> None:
+        self._valid_actions = None
+        self._win = None
+
     def get_possible_actions(self, only_valid: bool) -> list[GameAction]:
+        if only_valid and self._valid_actions is not None:
+            self._valid_actions = [action.bound_to(self) for action in self._valid_actions]
+            return list(self._valid_actions)
         actions: list[GameAction] = []
         if self.draw_pile is not None:
             actions.append(GameAction(self.draw))
         if only_valid:
-            for src_pilename, dest_pilename in self.move_conditions.keys():
-                actions += self._get_move_actions(src_pilename, dest_pilename, only_valid)
-            for src_pilename, dest_pilename in self.move_stack_conditions.keys():
-                actions += self._get_move_stack_actions(src_pilename, dest_pilename, only_valid)
+            for src_pilename, dest_pilenames in self.move_index.items():
+                actions += self._get_move_actions(src_pilename, dest_pilenames, only_valid)
+            for src_pilename, dest_pilenames in self.move_stack_index.items():
+                actions += self._get_move_stack_actions(src_pilename, dest_pilenames, only_valid)
         else:
             for src_pilename in self.name_to_piles.keys():
                 for dest_pilename in list(self.name_to_piles.keys()) + ['DRAW']:
-                    actions += self._get_move_actions(src_pilename, dest_pilename, only_valid)
-                    actions += self._get_move_stack_actions(src_pilename, dest_pilename, only_valid)
+                    actions += self._get_move_actions(src_pilename, [dest_pilename], only_valid)
+                    actions += self._get_move_stack_actions(src_pilename, [dest_pilename], only_valid)
         if only_valid:
-            return self._filter_valid(actions)
+            actions = self._filter_valid(actions)
+            self._valid_actions = actions
+            return list(actions)
         return actions
 
+    # counting does not need the cached actions to be rebound to this copy
+    def count_possible_actions(self) -> int:
+        if self._valid_actions is None:
+            self.get_possible_actions(True)
+        assert self._valid_actions is not None
+        return len(self._valid_actions)
+
     def get_game_view(self) -> str:
         ret = self.name + '\n'
         if self.draw_pile is not None:
-            ret += self.draw_pile.get_game_view() + '\n'
+            ret += self.draw_pile.get_cached_game_view() + '\n'
         for piles in self.name_to_piles.values():
             for pile in piles:
-                ret += pile.get_game_view() + '\n'
+                ret += pile.get_cached_game_view() + '\n'
         return ret
     
     # TODO remove duplicate code (get_state_view/get_game_view)
     def get_state_view(self) -> str:
         ret = self.name + '\n'
         if self.draw_pile is not None:
-            ret += self.draw_pile.get_state_view() + '\n'
+            ret += self.draw_pile.get_cached_state_view() + '\n'
         for piles in self.name_to_piles.values():
             for pile in piles:
-                ret += pile.get_state_view() + '\n'
+                ret += pile.get_cached_state_view() + '\n'
         return ret
\ No newline at end of file
@@ -1,7 +1,30 @@
-from game import Game, PilePos, StackPilePos, RunPos, DrawPilePos
-from typing import TypeVar, List, Callable
+from game import Game, PilePos, StackPilePos, RunPos, DrawPilePos, UndoRecord
+from typing import TypeVar, List, Callable, NamedTuple
 from base import Deck, Suit, Card, Stack
 import condition as cond
+import re
+import os
+from utility import Logger
+
+_LIST_RE = re.compile(r"\s*,\s*")
+_SUIT = {'SPADES': Suit.Spades, 'HEARTS': Suit.Hearts, 'CLUBS': Suit.Clubs, 'DIAMONDS': Suit.Diamonds}
+_SUIT_SHORT = {'S': Suit.Spades, 'H': Suit.Hearts, 'C': Suit.Clubs, 'D': Suit.Diamonds}
+_RANK = {str(rank): rank for rank in range(1, 11)} | {'J': 11, 'Q': 12, 'K': 13}
+_TEMPLATE_CACHE: dict[str, tuple[int, Game]] = {} # parsed (not started) games by filename, with the file modification time
+
+class DrawAction(NamedTuple):
+    pass
+
+class MoveAction(NamedTuple):
+    src_pos: PilePos
+    dest_pos: StackPilePos
+
+class MoveStackAction(NamedTuple):
+    src_pos: RunPos
+    dest_pos: StackPilePos
+
+ParsedAction = DrawAction|MoveAction|MoveStackAction
+_ACTION_CACHE: dict[str, ParsedAction] = {} # parsed actions, there are only so many different action strings
 
 class Parser:
     @staticmethod
@@ -18,45 +41,31 @@ class Parser:
     
     @staticmethod
     def parse_suit(s: str) -> Suit:
-        if s == 'SPADES':
-            return Suit.Spades
-        elif s == 'HEARTS':
-            return Suit.Hearts
-        elif s == 'CLUBS':
-            return Suit.Clubs
-        elif s == 'DIAMONDS':
-            return Suit.Diamonds
-        raise Exception(f"Suit not recognized: {s}")
+        try:
+            return _SUIT[s]
+        except KeyError:
+            raise Exception(f"Suit not recognized: {s}")
     
     @staticmethod
     def parse_short_suit(s: str) -> Suit:
-        if s == 'S':
-            return Suit.Spades
-        elif s == 'H':
-            return Suit.Hearts
-        elif s == 'C':
-            return Suit.Clubs
-        elif s == 'D':
-            return Suit.Diamonds
-        raise Exception(f"Suit not recognized: {s}")
+        try:
+            return _SUIT_SHORT[s]
+        except KeyError:
+            raise Exception(f"Suit not recognized: {s}")
     
     @staticmethod
     def parse_rank(s: str) -> int:
-        if s == 'K':
-            return 13
-        elif s == 'Q':
-            return 12
-        elif s == 'J':
-            return 11
-        rank = int(s)
-        assert rank >= 1 and rank <= 10, f"Rank is not in the expected range: {s}; it should be in range [1, 10] or J/Q/K"
-        return rank
+        try:
+            return _RANK[s]
+        except KeyError:
+            raise Exception(f"Rank is not in the expected range: {s}; it should be in range [1, 10] or J/Q/K")
     
     @staticmethod
     def parse_card(s: str, is_face_down: bool = False) -> Card:
-        suit = Parser.parse_short_suit(s[0])
-        rank = Parser.parse_rank(s[1:])
-        return Card(suit, rank, is_face_down)
+        try:
+            return Card(_SUIT_SHORT[s[0]], _RANK[s[1:]], is_face_down)
+        except KeyError:
+            raise Exception(f"Card not recognized: {s}")
     
     @staticmethod
     def parse_pile_face(s: str) -> Stack.Face:
@@ -67,8 +76,7 @@ class Parser:
     
     @staticmethod
     def parse_list(s: str) -> list[str]:
-        s = s.strip()
-        return [part.strip() for part in s.split(',')]
+        return _LIST_RE.split(s.strip())
     
     T = TypeVar('T')
     @staticmethod
@@ -130,8 +138,7 @@ class Parser:
         _, count_text, suits_text = Parser.split_line(deck_desc[0])
         count = Parser.parse_number(count_text)
         suits = Parser.parse_items(suits_text, Parser.parse_suit)
-        game.deck = Deck(count, suits)
-        game.deck.shuffle(seed)
+        game.define_deck(Deck(count, suits), seed)
 
     @staticmethod
     def apply_initial(initial_desc: list[str], game: Game):
@@ -303,21 +310,40 @@ class Parser:
     @staticmethod
     def parse(game_desc: str, seed: int|None, should_log: bool, should_start: bool) -> Game:
         game_desc = Parser.remove_comments(game_desc)
-        lines = game_desc.splitlines()
-        name = lines[0]
+        lines = iter(game_desc.splitlines())
+        name = next(lines)
         game = Game(name, should_log)
-        section_ind = [i for i in range(len(lines)) if '$' in lines[i]] + [len(lines)]
-        sections = [lines[section_ind[i]:section_ind[i+1]] for i in range(len(section_ind)-1)]
-        for section in sections:
+        section: list[str]|None = None
+        for line in lines:
+            if line.startswith('$'):
+                if section is not None:
+                    Parser.apply(section, game, seed)
+                section = [line]
+            elif section is not None:
+                section.append(line)
+        if section is not None:
             Parser.apply(section, game, seed)
         if should_start:
             game.start()
         return game
     
+    # Started games are dealt from a template that is parsed once per file (and again if the file changes).
+    # Games that are not started are parsed every time, since they are started by the caller.
     @staticmethod
     def from_file(filename: str, seed: int|None, should_log: bool, should_start: bool) -> Game:
-        with open(filename, 'r') as f:
-            game = Parser.parse(f.read(), seed, should_log, should_start)
+        if not should_start:
+            with open(filename, 'r') as f:
+                return Parser.parse(f.read(), seed, should_log, should_start)
+        mtime = os.stat(filename).st_mtime_ns
+        cached = _TEMPLATE_CACHE.get(filename, None)
+        if cached is None or cached[0] != mtime:
+            with open(filename, 'r') as f:
+                cached = (mtime, Parser.parse(f.read(), seed, False, False))
+            _TEMPLATE_CACHE[filename] = cached
+        template = cached[1]
+        template.restart(seed)
+        game = template.copy()
+        game.logger = Logger(should_log)
         return game
     
     @staticmethod
@@ -337,26 +363,63 @@ class Parser:
         stack_str, ind_str = s.split(':')
         return RunPos(Parser.parse_stack_position(stack_str), Parser.parse_number(ind_str))
 
+    # the parsed actions are shared and their positions should not be changed
+    @staticmethod
+    def parse_action(s: str) -> ParsedAction:
+        parsed = _ACTION_CACHE.get(s, None)
+        if parsed is None:
+            parts = s.split()
+            if parts[0] == 'draw':
+                parsed = DrawAction()
+            elif parts[0] == 'move':
+                parsed = MoveAction(Parser.parse_pile_position(parts[1]), Parser.parse_stack_position(parts[2]))
+            elif parts[0] == 'move_stack':
+                parsed = MoveStackAction(Parser.prase_run_pos(parts[1]), Parser.parse_stack_position(parts[2]))
+            else:
+                raise Exception(f"Action not recognized: {s}")
+            _ACTION_CACHE[s] = parsed
+        return parsed
+
     @staticmethod
     def perform_action_in_game(s: str, game: Game, perform: bool = True) -> bool:
-        parts = s.split()
-        if parts[0] == 'draw':
-            return game.draw(perform)
-        elif parts[0] == 'move':
-            return game.move(Parser.parse_pile_position(parts[1]), Parser.parse_stack_position(parts[2]), perform)
-        elif parts[0] == 'move_stack':
-            return game.move_stack(Parser.prase_run_pos(parts[1]), Parser.parse_stack_position(parts[2]), perform)
+        action = Parser.parse_action(s)
+        if isinstance(action, MoveAction):
+            return game.move(action.src_pos, action.dest_pos, perform)
+        elif isinstance(action, MoveStackAction):
+            return game.move_stack(action.src_pos, action.dest_pos, perform)
         else:
-            raise Exception(f"Action not recognized: {s}")
+            return game.draw(perform)
+
+    # performs the action in place, the returned record takes it back with undo_action_in_game
+    @staticmethod
+    def perform_action_with_undo(s: str, game: Game) -> tuple[bool, UndoRecord]:
+        game.begin_undo()
+        try:
+            valid = Parser.perform_action_in_game(s, game)
+        finally:
+            undo = game.end_undo()
+        return valid, undo
+
+    @staticmethod
+    def undo_action_in_game(game: Game, undo: UndoRecord) -> None:
+        game.undo(undo)
         
+    # hash of the game after the action, without performing it; None when it has to be performed to know
+    @staticmethod
+    def get_action_hash(s: str, game: Game) -> int|None:
+        action = Parser.parse_action(s)
+        if isinstance(action, MoveAction):
+            return game.get_move_hash(action.src_pos, action.dest_pos)
+        elif isinstance(action, MoveStackAction):
+            return game.get_move_stack_hash(action.src_pos, action.dest_pos)
+        return None # draw changes too many piles
+
     @staticmethod
     def get_action_summary(s: str, game: Game, all_resolutions: bool = True, explain: bool = True) -> str:
-        parts = s.split()
-        if parts[0] == 'draw':
-            return game.get_draw_summary(all_resolutions, explain)
-        elif parts[0] == 'move':
-            return game.get_move_summary(all_resolutions, explain, Parser.parse_pile_position(parts[1]), Parser.parse_stack_position(parts[2]))
-        elif parts[0] == 'move_stack':
-            return game.get_move_stack_summary(all_resolutions, explain, Parser.prase_run_pos(parts[1]), Parser.parse_stack_position(parts[2]))
+        action = Parser.parse_action(s)
+        if isinstance(action, MoveAction):
+            return game.get_move_summary(all_resolutions, explain, action.src_pos, action.dest_pos)
+        elif isinstance(action, MoveStackAction):
+            return game.get_move_stack_summary(all_resolutions, explain, action.src_pos, action.dest_pos)
         else:
-            raise Exception(f"Action not recognized: {s}")
\ No newline at end of file
+            return game.get_draw_summary(all_resolutions, explain)
\ No newline at end of file
@@ -1,14 +1,18 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 from game import Game
-from utility import get_max_elements
+from utility import BoundedCache
 import random
 from parser import Parser
-from typing import Callable
+from typing import Callable, Generator, Iterable
 import math
 import time
+from bisect import bisect
+from itertools import accumulate
 
 class StateEval(ABC):
+    __slots__ = ('max_value',)
+
     def __init__(self, max_value: int) -> None:
         self.max_value = max_value
     
@@ -20,6 +24,8 @@ class StateEval(ABC):
         return self.get_value(state, action) / self.max_value
     
 class MergedHeuristic(StateEval):
+    __slots__ = ('state_evals',)
+
     def __init__(self, state_evals: list[StateEval]) -> None:
         super().__init__(0)
         self.state_evals = state_evals
@@ -31,6 +37,8 @@ class MergedHeuristic(StateEval):
         return sum(state_eval.get_value(state, action) for state_eval in self.state_evals) / len(self.state_evals)
 
 class WinHeuristic(StateEval):
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__(1)
     
@@ -40,6 +48,8 @@ class WinHeuristic(StateEval):
         return 0
     
 class NoDrawHeuristic(StateEval):
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__(1)
 
@@ -49,88 +59,136 @@ class NoDrawHeuristic(StateEval):
         return 1
     
 class SpiderHeuristic(StateEval):
+    __slots__ = ('cache',)
+
     def __init__(self) -> None:
         super().__init__(200*8)
+        self.cache: BoundedCache[int, int] = BoundedCache(1 << 16)
 
     def get_value(self, state: Game, action: str | None) -> int:
-        score = 0
-        for pile in state.name_to_piles['FOUNDATION']:
-            if pile.len() > 0:
-                score += 200
+        cached = self.cache.get(state.zobrist)
+        if cached is not None:
+            return cached
+        score = 200 * sum(1 for pile in state.name_to_piles['FOUNDATION'] if pile.cards)
         for pile in state.name_to_piles['COLUMN']:
+            cards = pile.cards
             stack_size = 1
-            for i in range(pile.len() - 2, -1, -1):
-                if pile.cards[i].suit == pile.cards[i+1].suit and pile.cards[i].rank == pile.cards[i+1].rank + 1 and not pile.cards[i].face_down:
-                    stack_size += 1
-                else:
+            for i in range(len(cards) - 2, -1, -1):
+                below, above = cards[i], cards[i+1]
+                if below.face_down or below.suit != above.suit or below.rank != above.rank + 1:
                     break
+                stack_size += 1
             score += stack_size * stack_size
+        self.cache.put(state.zobrist, score)
         return score
 
 class ActionCountHeuristic(StateEval):
+    __slots__ = ('cache',)
+
     def __init__(self) -> None:
         super().__init__(1000)
+        self.cache: BoundedCache[int, int] = BoundedCache(1 << 16)
 
     def get_value(self, state: Game, action: str | None) -> int:
+        cached = self.cache.get(state.zobrist)
+        if cached is not None:
+            return cached
         if state.is_win():
-            return int(1000) # an estimate
-        return len(state.get_possible_actions(True))
+            value = int(1000) # an estimate
+        else:
+            value = state.count_possible_actions()
+        self.cache.put(state.zobrist, value)
+        return value
 
 class Player(ABC):
     # This function returns an str instead of a GameAction,
     # since the current_state is most likely a copy, and we want to prevent
-    # the caller from using action.act, since it will be applied on the copied version
+    # the caller from using action.act, since it will be applied on the copied version.
+    # current_state should not be kept after returning, the caller may release it for reuse
     @abstractmethod
     def decide_action(self, current_state: Game) -> str|None:
         raise NotImplementedError
 
-    def _get_performed_state(self, current_state: Game, action: str) -> Game:
-        new_state = current_state.copy()
-        new_state.logger.temp_deactivate()
-        Parser.perform_action_in_game(action, new_state)
-        return new_state
-    
+    # called before a player is reused for another rollout of MCTS
+    def reset_for_new_rollout(self) -> None:
+        pass
+
     def _get_actions(self, current_state: Game) -> list[str]:
         return [str(action) for action in current_state.get_possible_actions(True)]
     
-    def _get_state_actions(self, current_state: Game) -> list[tuple[Game, str]]:
-        actions = self._get_actions(current_state)
-        return [(self._get_performed_state(current_state, action), action) for action in actions]
+    # Each action is performed on current_state itself and taken back when the iteration moves on (or is closed),
+    # so a yielded state is only valid until then. current_state is left unchanged in the end.
+    def _get_state_actions(self, current_state: Game) -> Generator[tuple[Game, str], None, None]:
+        return self._perform_each(current_state, self._get_actions(current_state))
+
+    def _perform_each(self, current_state: Game, actions: list[str]) -> Generator[tuple[Game, str], None, None]:
+        active = current_state.logger.active
+        current_state.logger.active = False
+        try:
+            for action in actions:
+                _, undo = Parser.perform_action_with_undo(action, current_state)
+                try:
+                    yield current_state, action
+                finally:
+                    Parser.undo_action_in_game(current_state, undo)
+        finally:
+            current_state.logger.active = active
     
 class RandomPlayer(Player):
     def __init__(self, seed: int|None = None, heuristic: StateEval|None=None) -> None:
         self.random = random.Random(seed)
         self.heuristic = heuristic
 
-    def _weighted_choice(self, state_actions: list[tuple[Game, str]]) -> str|None:
-        if len(state_actions) == 0:
+    # the heuristic is evaluated while each state is performed, since the states are not kept
+    def _choose(self, state_actions: Iterable[tuple[Game, str]]) -> str|None:
+        actions: list[str] = []
+        values: list[float] = []
+        for new_state, action in state_actions:
+            actions.append(action)
+            if self.heuristic is not None:
+                values.append(self.heuristic.get_normalized_value(new_state, action))
+        return self._weighted_choice(actions, values)
+
+    def _weighted_choice(self, actions: list[str], values: list[float]) -> str|None:
+        if len(actions) == 0:
             return None
-        if self.heuristic is None:
-            return self.random.choice(state_actions)[1]
-        values = [self.heuristic.get_normalized_value(new_state, action) for new_state, action in state_actions]
-        return self.random.choices(state_actions, values, k=1)[0][1]
+        if len(values) == 0:
+            return actions[self.random.randrange(len(actions))]
+        cumulative_values = list(accumulate(values))
+        total = cumulative_values[-1]
+        if total <= 0: # no preference between the actions
+            return actions[self.random.randrange(len(actions))]
+        return actions[bisect(cumulative_values, self.random.random() * total, 0, len(actions) - 1)]
 
     def decide_action(self, current_state: Game) -> str|None:
-        state_actions = self._get_state_actions(current_state)
-        action = self._weighted_choice(state_actions)
-        return action if action is not None else None
+        if self.heuristic is None: # no need to perform the actions
+            return self._weighted_choice(self._get_actions(current_state), [])
+        return self._choose(self._get_state_actions(current_state))
     
 class NoRepeatPlayer(Player):
-    HASH_TYPE = str # TODO generic
+    HASH_TYPE = int # TODO generic
     def __init__(self) -> None:
         self.seen_states: set[NoRepeatPlayer.HASH_TYPE] = set()
     
     def _hash(self, state: Game) -> HASH_TYPE:
-        return state.get_game_view()
+        return state.zobrist
     
     def _register_state(self, current_state: Game):
         self.seen_states.add(self._hash(current_state))
+
+    def reset_for_new_rollout(self) -> None:
+        self.seen_states.clear()
     
-    def _get_new_state_actions(self, current_state: Game) -> list[tuple[Game, str]]:
-        state_actions = self._get_state_actions(current_state)
-        actions = [(new_state, action) for new_state, action in state_actions\
-                   if self._hash(new_state) not in self.seen_states]
-        return actions
+    def _get_new_state_actions(self, current_state: Game) -> Generator[tuple[Game, str], None, None]:
+        # actions leading to a seen state are dropped before performing them, when their hash can be known beforehand
+        actions: list[str] = []
+        for action in self._get_actions(current_state):
+            hash = Parser.get_action_hash(action, current_state)
+            if hash is None or hash not in self.seen_states:
+                actions.append(action)
+        for new_state, action in self._perform_each(current_state, actions):
+            if self._hash(new_state) not in self.seen_states:
+                yield new_state, action
     
 class DFSPlayer(NoRepeatPlayer):
     def __init__(self, heuristic: StateEval|None) -> None:
@@ -140,12 +198,13 @@ class DFSPlayer(NoRepeatPlayer):
     def decide_action(self, current_state: Game) -> str | None:
         self._register_state(current_state)
         state_actions = self._get_new_state_actions(current_state)
-        if len(state_actions) == 0:
-            return None
-        if self.heuristic is not None:
-            not_none_heuristic: StateEval = self.heuristic # otherwise, next line will raise typing errors, even though it's correct
-            return max(state_actions, key=lambda state_action: not_none_heuristic.get_value(state_action[0], state_action[1]))[1]
-        return state_actions[0][1]
+        if self.heuristic is None:
+            first = next(state_actions, None)
+            state_actions.close() # takes back the performed action
+            return first[1] if first is not None else None
+        not_none_heuristic: StateEval = self.heuristic # otherwise, next line will raise typing errors, even though it's correct
+        best = max(state_actions, key=lambda state_action: not_none_heuristic.get_value(state_action[0], state_action[1]), default=None)
+        return best[1] if best is not None else None
 
 class RandomNoRepeatPlayer(RandomPlayer, NoRepeatPlayer):
     def __init__(self, seed:int|None = None, heuristic: StateEval|None = None) -> None:
@@ -155,90 +214,127 @@ class RandomNoRepeatPlayer(RandomPlayer, NoRepeatPlayer):
     def decide_action(self, current_state: Game) -> str|None:
         assert current_state not in self.seen_states
         self._register_state(current_state)
-        state_actions = self._get_new_state_actions(current_state)
-        action = self._weighted_choice(state_actions)
+        action = self._choose(self._get_new_state_actions(current_state))
         return str(action) if action is not None else None
 
+_INV_SQRT = [0.0] + [1 / math.sqrt(visits) for visits in range(1, 4096)]
+
+# sqrt(log(parent visits)) is the same for all siblings, so the caller computes it once
+def ucb(reward: float, visits: int, sqrt_log_parent_visits: float, explore_factor: float = 0.5) -> float:
+    if visits == 0:
+        return 0 if explore_factor == 0 else math.inf
+    inv_sqrt_visits = _INV_SQRT[visits] if visits < len(_INV_SQRT) else 1 / math.sqrt(visits)
+    return reward / visits + explore_factor * sqrt_log_parent_visits * inv_sqrt_visits
+
 class MCTSNode:
-    def __init__(self, state: Game) -> None:
-        self.state: Game = state
+    __slots__ = ('_state', 'visits', 'reward', 'children', 'parent', 'action')
+
+    # the root is given its state, other nodes are given the parent and the action that leads to them
+    def __init__(self, state: Game|None, parent: MCTSNode|None = None, action: str|None = None) -> None:
+        self._state: Game|None = state
         self.visits: int = 0
         self.reward: float = 0
-        self.children: dict[str, MCTSChild] = {}
-    
-    def add_child(self, child: MCTSChild) -> None:
-        self.children[child.action] = child
-    
-    def get_children(self) -> list[MCTSChild]:
-        return list(self.children.values())
-    
-    def is_leaf(self) -> bool:
-        return len(self.children) == 0
-    
-    def create_child(self, new_state: Game, performed_action: str) -> MCTSChild:
-        return MCTSChild(new_state, self, performed_action)
-    
-class MCTSChild(MCTSNode):
-    def __init__(self, state: Game, parent: MCTSNode, action: str) -> None:
-        super().__init__(state)
+        self.children: list[MCTSNode] = [] # each action is expanded once, so a list is enough
         self.parent = parent
         self.action = action
 
+    # the state of a child is only created when it is visited, most children of a wide node never are
     @property
-    def ucb(self, explore_factor: float = 0.5):
-        if self.visits == 0:
-            return 0 if explore_factor == 0 else math.inf
-        else:
-            exploit_term = self.reward / self.visits
-            explore_term = math.sqrt(math.log(self.parent.visits) / self.visits)
-            return exploit_term + explore_factor * explore_term
+    def state(self) -> Game:
+        if self._state is None:
+            self._state = self.build_state()
+        return self._state
+
+    # replays the actions from the closest ancestor that still has its state
+    def build_state(self) -> Game:
+        actions: list[str] = []
+        node: MCTSNode = self
+        while node._state is None:
+            assert node.parent is not None and node.action is not None
+            actions.append(node.action)
+            node = node.parent
+        state = node._state.silent_copy()
+        for action in reversed(actions):
+            Parser.perform_action_in_game(action, state)
+        return state
+
+    def discard_state(self) -> None:
+        if self._state is not None:
+            self._state.release() # states of the nodes are never shared
+        self._state = None
+    
+    def add_child(self, child: MCTSNode) -> None:
+        self.children.append(child)
+    
+    def is_leaf(self) -> bool:
+        return not self.children
+    
+    def create_child(self, performed_action: str) -> MCTSNode:
+        return MCTSNode(None, self, performed_action)
 
 class MCTSPlayer(Player):
-    HASH_TYPE = str
+    HASH_TYPE = int
     def __init__(self, time_budget: int, seed: int|None, max_rollout_depth: int,
-                 rollout_strategist_gen: Callable[[], Player], reward_func: StateEval) -> None:
+                 rollout_strategist_gen: Callable[[], Player], reward_func: StateEval, discard_expanded_states: bool = False) -> None:
         self.time_budget = time_budget
         self.random = random.Random(seed)
         self.hash_to_node: dict[MCTSPlayer.HASH_TYPE, MCTSNode] = {}
         self.max_rollout_depth: int = max_rollout_depth
         self.rollout_strategist_gen = rollout_strategist_gen
         self.reward_func = reward_func
+        # only keep the states of the unexpanded nodes (and the roots), the others are rebuilt when needed
+        self.discard_expanded_states = discard_expanded_states
+        # rollouts often end in the same positions; the reward can depend on the last action too
+        self.terminal_reward_cache: BoundedCache[tuple[MCTSPlayer.HASH_TYPE, str|None], float] = BoundedCache(1 << 16)
     
     def _get_hash(self, game: Game) -> HASH_TYPE:
-        return str(game)
+        return game.zobrist
 
     def _get_state_copy(self, state: Game):
-        state = state.copy()
-        state.logger.active = False
-        return state
+        return state.silent_copy()
     
     def _register_hash(self, node: MCTSNode):
         hash = self._get_hash(node.state)
-        self.hash_to_node[hash] = node
+        # on a transposition the first node is kept, it is the one the root lookup should find
+        self.hash_to_node.setdefault(hash, node)
 
     def _expand(self, node: MCTSNode):
-        options = self._get_state_actions(node.state)
-        for new_state, action in options:
-            if self._get_hash(new_state) in self.hash_to_node:
-                continue
-            child = node.create_child(new_state, action)
-            node.add_child(child)
-            self._register_hash(child)
+        for action in self._get_actions(node.state):
+            node.add_child(node.create_child(action))
     
-    def _select_node(self, node: MCTSNode) -> MCTSNode:
+    def _select_node(self, root: MCTSNode) -> MCTSNode:
+        node = root
         while not node.is_leaf():
-            max_nodes = get_max_elements(node.get_children(), lambda child: child.ucb)
-            node = self.random.choice(max_nodes)
+            # single pass argmax, ties are broken uniformly using reservoir sampling
+            best_child: MCTSNode|None = None
+            best_ucb = -math.inf
+            ties = 0
+            sqrt_log_visits = math.sqrt(math.log(max(node.visits, 1)))
+            for child in node.children:
+                child_ucb = ucb(child.reward, child.visits, sqrt_log_visits)
+                if child_ucb > best_ucb:
+                    best_child, best_ucb, ties = child, child_ucb, 1
+                elif child_ucb == best_ucb:
+                    ties += 1
+                    if self.random.randrange(ties) == 0:
+                        best_child = child
+            assert best_child is not None
+            node = best_child
             if node.visits == 0:
+                self._register_hash(node) # first visit, creates the state of the child
                 return node
         self._expand(node)
         if not node.is_leaf():
-            node = self.random.choice(node.get_children())
+            child = self.random.choice(node.children)
+            self._register_hash(child)
+            if self.discard_expanded_states and node is not root: # a reused root still has a parent
+                node.discard_state()
+            node = child
         return node
     
-    def _rollout(self, state: Game) -> float:
+    def _rollout(self, state: Game, rollout_strategist: Player) -> float:
         depth = 0
-        rollout_strategist = self.rollout_strategist_gen()
+        rollout_strategist.reset_for_new_rollout()
         last_action: None|str = None
         while not state.is_win() and depth < self.max_rollout_depth:
             action = rollout_strategist.decide_action(state)
@@ -247,33 +343,55 @@ class MCTSPlayer(Player):
             Parser.perform_action_in_game(action, state)
             last_action = action
             depth += 1
-        return self.reward_func.get_normalized_value(state, last_action)
+        key = (self._get_hash(state), last_action)
+        reward = self.terminal_reward_cache.get(key)
+        if reward is None:
+            reward = self.reward_func.get_normalized_value(state, last_action)
+            self.terminal_reward_cache.put(key, reward)
+        return reward
     
     def _backpropagate(self, node: MCTSNode, reward: float) -> None:
-        node.visits += 1
-        node.reward += reward
-        if isinstance(node, MCTSChild):
-            self._backpropagate(node.parent, reward)
+        current: MCTSNode|None = node
+        while current is not None:
+            current.visits += 1
+            current.reward += reward
+            current = current.parent
         
     def _get_best_action(self, node: MCTSNode) -> str|None:
-        if node.is_leaf():
-            return None
-        best_children = get_max_elements(node.get_children(), lambda child: child.reward/child.visits)
-        return self.random.choice(best_children).action
+        # single pass argmax over the visited children, ties are broken uniformly using reservoir sampling
+        best_child: MCTSNode|None = None
+        best_value = -math.inf
+        ties = 0
+        for child in node.children:
+            if child.visits == 0:
+                continue
+            value = child.reward / child.visits
+            if value > best_value:
+                best_child, best_value, ties = child, value, 1
+            elif value == best_value:
+                ties += 1
+                if self.random.randrange(ties) == 0:
+                    best_child = child
+        return best_child.action if best_child is not None else None
     
     def decide_action(self, current_state: Game) -> str | None:
         start_time = time.time()
-        node = self.hash_to_node.get(self._get_hash(current_state), None)
-        if node is None:
-            node = MCTSNode(current_state)
-            self._register_hash(node)
+        root = self.hash_to_node.get(self._get_hash(current_state), None)
+        if root is None:
+            root = MCTSNode(self._get_state_copy(current_state))
+            self._register_hash(root)
+        elif root._state is None: # state was discarded, but it is given here
+            root._state = self._get_state_copy(current_state)
+        rollout_strategist = self.rollout_strategist_gen() # shared by all rollouts of this decision
         node_count = 0
         while time.time() - start_time < self.time_budget:
-            node = self._select_node(node)
-            reward = self._rollout(self._get_state_copy(node.state))
+            node = self._select_node(root)
+            rollout_state = self._get_state_copy(node.state)
+            reward = self._rollout(rollout_state, rollout_strategist)
+            rollout_state.release()
             self._backpropagate(node, reward)
             node_count += 1
-        best_action = self._get_best_action(node)
+        best_action = self._get_best_action(root)
         print(node_count)
         if best_action is None:
             return str(self.random.choice(current_state.get_possible_actions(True)))
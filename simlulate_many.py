@@ -1,64 +1,88 @@
 from parser import Parser
 from player import Player, RandomPlayer, RandomNoRepeatPlayer, MCTSPlayer, WinHeuristic, ActionCountHeuristic, SpiderHeuristic, NoDrawHeuristic, MergedHeuristic, DFSPlayer
-from game import Game
+from game import Game, UndoRecord
 from joblib import delayed, Parallel
 from tqdm import tqdm
-from typing import Callable, Sequence
+from typing import Callable, Sequence, Iterable
 import time
 import random
+import io
+import os
+import json
 
-thread_count=10
+thread_count: int|None = None # None to use the cores available to this process
+inline_count = 4 # up to this many simulations run in this process when thread_count is not set, starting the workers costs more than they save
 
+# The views are rendered right away, so the game is not kept (or copied).
+# The action is performed on the game itself and taken back, unless keep_action is set
+# by a caller that would perform the action next anyway.
 class Sample:
-    def __init__(self, game: Game, action: str) -> None:
-        self.current: Game = game
+    __slots__ = ('action', 'current_state_view', 'current_game_view', 'summary', 'valid', 'next_state_view', 'next_game_view')
+
+    def __init__(self, game: Game, action: str, keep_action: bool = False) -> None:
         self.action: str = action
-        self.next: Game|None = game.copy()
-        self.valid: bool = True
-        self.summary = Parser.get_action_summary(action, self.current, all_resolutions=False, explain=True)
-        if not Parser.perform_action_in_game(action, self.next):
-            self.valid = False
-            self.next = None
+        self.current_state_view: str = game.get_state_view()
+        self.current_game_view: str = game.get_game_view()
+        self.summary = Parser.get_action_summary(action, game, all_resolutions=False, explain=True)
+        self.next_state_view: str|None = None
+        self.next_game_view: str|None = None
+        undo: UndoRecord|None = None
+        if keep_action:
+            self.valid = Parser.perform_action_in_game(action, game)
+        else:
+            self.valid, undo = Parser.perform_action_with_undo(action, game)
+        if self.valid:
+            self.next_state_view = game.get_state_view()
+            self.next_game_view = game.get_game_view()
+        if undo is not None:
+            Parser.undo_action_in_game(game, undo)
 
     def as_json(self) -> dict[str, str|bool|None]:
         return {
-            "current_state_view": self.current.get_state_view(),
-            "current_game_view": self.current.get_game_view(),
+            "current_state_view": self.current_state_view,
+            "current_game_view": self.current_game_view,
             "action": self.action,
             "summary": self.summary,
             "is_valid": self.valid,
-            "next_state_view": self.next.get_state_view() if self.next is not None else None,
-            "next_game_view": self.next.get_game_view() if self.next is not None else None,
+            "next_state_view": self.next_state_view,
+            "next_game_view": self.next_game_view,
         }
 
 def simulate_one(player: Player, game_filename: str, game_seed: int|None, max_moves: int|None,
                  sampling_seed: int|None, sample_rate: float = 0, invalid_actions_rate: float = 0, bot_action_rate: float = 0) -> tuple[Game, int, list[Sample]]:
     sample_rnd = random.Random(sampling_seed)
-    game = Parser.from_file(game_filename, game_seed, False, True)
+    game = Parser.from_file(game_filename, game_seed, False, True) # each worker parses the file only once
     game_samples: list[Sample] = []
     move_count = 0
+    # a single draw per move picks the kind of sample, with the same odds as the nested checks
+    invalid_threshold = sample_rate * invalid_actions_rate
+    bot_threshold = invalid_threshold * bot_action_rate
     while not game.is_win():
         game_copy = game.copy()
-        action: str|None = player.decide_action(game_copy)
+        try:
+            action: str|None = player.decide_action(game_copy)
+        finally:
+            game_copy.release()
         if action is None or move_count == max_moves:
             return game, move_count, game_samples
-        if sample_rnd.random() < sample_rate:
-            if sample_rnd.random() < invalid_actions_rate:
-                if sample_rnd.random() < bot_action_rate:
-                    game_samples.append(Sample(game.copy(), action))
-                else:
-                    actions = game.get_possible_actions(True)
-                    random_action = str(actions[sample_rnd.randint(0, len(actions) - 1)])
-                    game_samples.append(Sample(game.copy(), random_action))
-            else:
-                actions = game.get_possible_actions(False)
-                while True:
-                    random_action = str(actions[sample_rnd.randint(0, len(actions) - 1)])
-                    sample = Sample(game.copy(), random_action)
-                    if not sample.valid:
-                        game_samples.append(sample)
-                        break
-        Parser.perform_action_in_game(action, game)
+        performed = False
+        r = sample_rnd.random()
+        if r < bot_threshold:
+            game_samples.append(Sample(game, action, keep_action=True))
+            performed = True
+        elif r < invalid_threshold:
+            actions = game.get_possible_actions(True)
+            random_action = str(actions[sample_rnd.randrange(len(actions))])
+            game_samples.append(Sample(game, random_action))
+        elif r < sample_rate:
+            # same as retrying random actions until an invalid one is found, without building a sample for each try
+            valid_actions = set(str(action) for action in game.get_possible_actions(True))
+            invalid_actions = [str(action) for action in game.get_possible_actions(False) if str(action) not in valid_actions]
+            if len(invalid_actions) > 0:
+                random_action = invalid_actions[sample_rnd.randrange(len(invalid_actions))]
+                game_samples.append(Sample(game, random_action))
+        if not performed:
+            Parser.perform_action_in_game(action, game)
         move_count += 1
     return game, move_count, game_samples
 
@@ -71,23 +95,60 @@ def get_seeds(seeds: int|None|Sequence[int|None], count: int) -> Sequence[int|No
     assert len(seeds) == count
     return seeds
 
+def get_thread_count(count: int) -> int:
+    if thread_count is not None:
+        return thread_count
+    if hasattr(os, 'sched_getaffinity'): # not available on every platform
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    return max(1, min(count, cores))
+
 def simulate_for_player(count: int, max_moves: int|None, game_filename: str, player_creator: Callable[[], Player],
                         game_seeds: int|None|Sequence[int|None], sampling_seeds: int|None|Sequence[int|None],
                         sampling_rate: float, invalid_actions_rate: float, bot_action_rate: float) -> tuple[list[Game], list[int], list[Sample]]:
     game_seeds = get_seeds(game_seeds, count)
     sampling_seeds = get_seeds(sampling_seeds, count)
-    results = Parallel(n_jobs=thread_count)(delayed(simulate_one)(
-        player_creator(), game_filename, game_seed, max_moves, sampling_seed, sampling_rate, invalid_actions_rate, bot_action_rate) for game_seed, sampling_seed in tqdm(zip(game_seeds, sampling_seeds)))
-    # assert isinstance(results, list) and results is all(isinstance(item, (Game, int)) for item in results), "Parallel jobs have not resulted in an output of type list"
-    games = [game for game, _, _ in results] # type: ignore
-    move_counts = [move_count for _, move_count, _ in results] # type: ignore
-    samples = [sample for _, _, game_samples in results for sample in game_samples] # type: ignore
+    arguments = ((player_creator(), game_filename, game_seed, max_moves, sampling_seed, sampling_rate, invalid_actions_rate, bot_action_rate)
+                 for game_seed, sampling_seed in zip(game_seeds, sampling_seeds))
+    if thread_count is None and count <= inline_count:
+        results = (simulate_one(*args) for args in arguments)
+    else:
+        # results are streamed in order as the simulations finish, instead of waiting for the whole list
+        results = Parallel(n_jobs=get_thread_count(count), return_as="generator")(delayed(simulate_one)(*args) for args in arguments)
+    games: list[Game] = []
+    move_counts: list[int] = []
+    samples: list[Sample] = []
+    for game, move_count, game_samples in tqdm(results, total=count): # type: ignore
+        games.append(game)
+        move_counts.append(move_count)
+        samples += game_samples
     return games, move_counts, samples
 
+# samples are written one by one (one per line by default), the dataset is never built as a single object
+def save_dataset(filename: str, name: str, bot: str, samples: Iterable[Sample], indent: int|None = None) -> None:
+    with open(filename, "w") as file:
+        file.write(f'{{"name": {json.dumps(name)}, "bot": {json.dumps(bot)}, "samples": [')
+        separator = '\n'
+        for sample in samples:
+            file.write(separator)
+            file.write(json.dumps(sample.as_json(), indent=indent))
+            separator = ',\n'
+        file.write('\n]}\n')
+
 def report_results(games: list[Game], move_counts: list[int]):
-    print("games:\n" + '\n'.join([f'{i}\n' + game.get_state_view() for i, game in enumerate(games)])) # type: ignore
-    wins: list[bool] = [game.is_win() for game in games]
-    print(f"win_percentage: {sum(wins)/len(wins)}")
+    # the games are rendered and their wins are counted in one pass
+    report = io.StringIO()
+    report.write("games:\n")
+    wins = 0
+    for i, game in enumerate(games):
+        if i > 0:
+            report.write('\n')
+        report.write(f'{i}\n')
+        report.write(game.get_state_view())
+        wins += game.is_win()
+    print(report.getvalue())
+    print(f"win_percentage: {wins/len(games)}")
     print(f"move_count: {move_counts}")
     print(f"average_move_counts: {sum(move_counts)/len(move_counts)}")
 
@@ -116,17 +177,7 @@ if __name__ == '__main__':
     if len(samples) == 0:
         exit()
     game = Parser.from_file(game_filename, None, False, False)
-    dataset = {
-        "name": game.name,
-        "bot": "DFSBot",
-        "samples": [
-            sample.as_json()
-            for sample in samples
-        ]
-    }
-    import json, time
-    filename = f"results/{dataset['name']}_{dataset['bot']}_{int(time.time())}.json"
-    with open(filename, "w") as file:
-        json.dump(dataset, file, indent=4)
+    filename = f"results/{game.name}_DFSBot_{int(time.time())}.json"
+    save_dataset(filename, game.name, "DFSBot", samples)
     print(f"saved as {filename}")
     # simulate_for_player(1, 1000, game, lambda: MCTSPlayer(100, None, 100, lambda: RandomNoRepeatPlayer(None, ActionCountHeuristic()), WinHeuristic()))
@@ -1,5 +1,5 @@
 from enum import StrEnum
-from typing import TypeVar, Callable
+from typing import TypeVar, Callable, Generic
 
 class TextUtil:
     class TEXT_COLOR(StrEnum):
@@ -29,15 +29,9 @@ class Logger:
             print(s)
 
     def info_from(self, l: list[str|tuple[Callable, list]]):
-        s = ''
         if not self.active:
             return
-        for val in l:
-            if isinstance(val, str):
-                s += val
-            else:
-                s += val[0](*val[1])
-        self.info(s)
+        self.info(''.join(val if isinstance(val, str) else val[0](*val[1]) for val in l))
 
     def temp_activate(self):
         self.active = True
@@ -47,6 +41,44 @@ class Logger:
 
     def revert_activation(self):
         self.active = self.static_activate
+
+# logger for the games that are only simulated, it never prints and cannot be activated
+class NullLogger(Logger):
+    def __init__(self) -> None:
+        pass
+
+    @property
+    def active(self) -> bool:
+        return False
+
+    @active.setter
+    def active(self, active: bool) -> None:
+        pass
+
+    @property
+    def static_activate(self) -> bool:
+        return False
+
+    @static_activate.setter
+    def static_activate(self, active: bool) -> None:
+        pass
+
+    def info(self, s: str) -> None:
+        pass
+
+    def info_from(self, l: list[str|tuple[Callable, list]]):
+        pass
+
+    def temp_activate(self):
+        pass
+
+    def temp_deactivate(self):
+        pass
+
+    def revert_activation(self):
+        pass
+
+NULL_LOGGER = NullLogger()
     
 T = TypeVar('T')
 def cast(s: str, type_cast: Callable[..., T], default: T|None=None, supress_error:bool=True) -> T|None:
@@ -57,11 +89,21 @@ def cast(s: str, type_cast: Callable[..., T], default: T|None=None, supress_erro
             return default
         raise e
     
-G = TypeVar('G')
-def get_max_elements(elements: list[G], map_func: Callable[[G], float|int]) -> list[G]:
-        values: list[int|float] = [map_func(element) for element in elements]
-        max_value: float|int = max(values)
-        return [element for element, value in zip(elements, values) if value == max_value]
+K = TypeVar('K')
+V = TypeVar('V')
+class BoundedCache(Generic[K, V]):
+    # a dict that forgets its oldest entries once it is full
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.items: dict[K, V] = {}
+
+    def get(self, key: K) -> V|None:
+        return self.items.get(key, None)
+
+    def put(self, key: K, value: V) -> None:
+        if len(self.items) >= self.max_size:
+            del self.items[next(iter(self.items))]
+        self.items[key] = value
     
 def get_safe_filename(filename: str, timed:bool=False, extension:str|None=None):
     import time